@@ -1,9 +1,15 @@
 #! /usr/bin/env python3
 
+import collections
+import concurrent.futures
 import dataclasses
 import datetime
+import gzip
+import hashlib
+import itertools
 import json
 import operator
+import os
 import pathlib
 import sqlite3
 import typing as t
@@ -425,24 +431,65 @@ class Thing:
             self.creator.id_,
             self.default_image.id_ if self.default_image else None,
             self.description,
+            self.added,
+            self.like_count,
+            self.download_count,
+            self.make_count,
         )
 
 
-@click.command(name="thingiverse")
+@click.group(name="thingiverse")
+def cli():
+    pass
+
+
+@cli.command(name="ingest")
 @click.argument("src_dirs", nargs=-1)
 def main(src_dirs: list[str]):
     creator_id_saved: set[str] = set()
-    conn = sqlite3.connect("items.db")
-    conn.execute(CREATE_THING_TABLE)
-    conn.execute(CREATE_CREATOR_TABLE)
+    conn = connect()
     for item in load_all(src_dirs):
+        # aggregate tables are kept up to date by the triggers in CREATE_AGGREGATES
         conn.execute(INSERT_THING, item.as_tuple())
+        tags = [(item.id_, tag.tag) for tag in item.tags or []]
+        conn.execute(DELETE_STALE_THING_TAGS, (item.id_, json.dumps([tag for _, tag in tags])))
+        conn.executemany(INSERT_THING_TAG, tags)
         if item.creator.id_ not in creator_id_saved:
             conn.execute(INSERT_CREATOR, item.creator.as_tuple())
             creator_id_saved.add(item.creator.id_)
     conn.commit()
 
 
+@cli.command(name="rebuild-aggregates")
+@click.option("--check", is_flag=True, help="Only report rows that differ from a full recompute.")
+def rebuild_aggregates(check: bool):
+    conn = connect()
+    for table, query in REBUILD_AGGREGATES.items():
+        conn.execute(f"DROP TABLE IF EXISTS temp.{table}")
+        conn.execute(f"CREATE TEMP TABLE {table} AS {query}")
+        differ = conn.execute(
+            f"""
+            SELECT
+                (SELECT count(*) FROM (SELECT * FROM main.{table} EXCEPT SELECT * FROM temp.{table}))
+                + (SELECT count(*) FROM (SELECT * FROM temp.{table} EXCEPT SELECT * FROM main.{table}))
+            """
+        ).fetchone()[0]
+        click.echo(f"{table}: {differ} rows differ")
+        if not check:
+            conn.execute(f"DELETE FROM main.{table}")
+            conn.execute(f"INSERT INTO main.{table} SELECT * FROM temp.{table}")
+    conn.commit()
+
+
+def connect() -> sqlite3.Connection:
+    conn = sqlite3.connect("items.db")
+    conn.execute(CREATE_THING_TABLE)
+    conn.execute(CREATE_CREATOR_TABLE)
+    conn.execute(CREATE_THING_TAG_TABLE)
+    conn.executescript(CREATE_AGGREGATES)
+    return conn
+
+
 # @click.command(name="thingiverse")
 # @click.argument("src_dirs", nargs=-1)
 # def main(src_dirs: list[str]):
@@ -467,19 +514,170 @@ def load_all(src_dirs: list[str]):
     for src_dir in src_dirs:
         if (p := pathlib.Path(src_dir)).is_dir():
             for item in p.rglob("*.json"):
+                if "." in item.stem:
+                    # sub-resource saved next to the thing, e.g. 0000001.files.json
+                    continue
                 with item.open(mode="r") as f:
                     data = json.load(f)
                     if "id" in data:
                         yield Thing.load(data)
 
 
+# results are stored as d/d/d/d/ddddddd.json, see crawl.get_filename
+ID_DIGITS = 7
+ID_DIR_DEPTH = 4
+
+EXPORT_MANIFEST = "manifest.json"
+
+
+@cli.command(name="export")
+@click.argument("src_dir", default="./results")
+@click.argument("dst_dir", default="./export")
+@click.option("--start", default=1, help="First thing id to export, rounded down to a shard.")
+@click.option("--end", default=10**ID_DIGITS - 1, help="Last thing id to export, rounded up to a shard.")
+@click.option("--normalize/--raw", default=False, help="Pass records through Thing.load.")
+@click.option("--shard-size", default=100000, help="Thing ids covered by each shard.")
+@click.option("--chunk-size", default=8 * 1024 * 1024, help="Bytes compressed per job.")
+@click.option("--level", default=6, help="Gzip compression level.")
+@click.option("--workers", default=os.cpu_count() or 1, help="Compression processes.")
+@click.option("--max-in-flight", default=0, help="Chunks queued for compression, default 2 per worker.")
+def export(
+    src_dir: str,
+    dst_dir: str,
+    start: int,
+    end: int,
+    normalize: bool,
+    shard_size: int,
+    chunk_size: int,
+    level: int,
+    workers: int,
+    max_in_flight: int,
+):
+    dst = pathlib.Path(dst_dir)
+    dst.mkdir(parents=True, exist_ok=True)
+    manifest_path = dst / EXPORT_MANIFEST
+    manifest: dict[str, str] = {}
+    if manifest_path.exists():
+        with manifest_path.open(mode="r") as f:
+            manifest = json.load(f)
+    max_in_flight = max_in_flight or 2 * workers
+    # shards are finished in submit order, a None future closes the shard
+    in_flight: collections.deque = collections.deque()
+    produced: set[str] = set()
+
+    def drain(limit: int):
+        while len(in_flight) > limit:
+            shard, future = in_flight.popleft()
+            if future is not None:
+                shard["file"].write(future.result())
+                continue
+            shard["file"].close()
+            if not shard["records"]:
+                # only forbidden or not found stubs, an empty file is not valid gzip
+                shard["tmp"].unlink()
+                continue
+            shard["tmp"].replace(dst / shard["name"])
+            produced.add(shard["name"])
+            manifest[shard["name"]] = shard["fingerprint"]
+            with manifest_path.open(mode="w") as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+
+    # shards always hold their whole aligned range, so their contents don't depend on start..end
+    start = start // shard_size * shard_size
+    end = (end // shard_size + 1) * shard_size - 1
+    files = iter_thing_files(pathlib.Path(src_dir), start, end)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for shard_id, group in itertools.groupby(files, key=lambda item: item[0] // shard_size):
+            items = [*group]
+            # names cover the whole aligned range so they don't move with --start/--end
+            first_id = shard_id * shard_size
+            last_id = (shard_id + 1) * shard_size - 1
+            name = f"things-{first_id:0{ID_DIGITS}d}-{last_id:0{ID_DIGITS}d}.ndjson.gz"
+            fingerprint = get_fingerprint(items, normalize, level)
+            if manifest.get(name) == fingerprint and (dst / name).exists():
+                produced.add(name)
+                continue
+            tmp = dst / f"{name}.tmp"
+            shard = {"name": name, "tmp": tmp, "file": tmp.open(mode="wb"), "fingerprint": fingerprint, "records": 0}
+            buffer: list[bytes] = []
+            buffer_size = 0
+            for _, path in items:
+                if (line := export_line(path, normalize)) is None:
+                    continue
+                buffer.append(line)
+                buffer_size += len(line)
+                shard["records"] += 1
+                if buffer_size >= chunk_size:
+                    drain(max_in_flight - 1)
+                    in_flight.append((shard, executor.submit(gzip.compress, b"".join(buffer), level)))
+                    buffer, buffer_size = [], 0
+            if buffer:
+                drain(max_in_flight - 1)
+                in_flight.append((shard, executor.submit(gzip.compress, b"".join(buffer), level)))
+            in_flight.append((shard, None))
+        drain(0)
+    # shards overlapping start..end that this run did not produce are emptied or
+    # from an older layout, shards outside the range are left alone
+    stale = {path.name for path in dst.glob("things-*.ndjson.gz")} | {*manifest}
+    for name in stale - produced:
+        first_id, last_id = (int(part) for part in name[len("things-") : -len(".ndjson.gz")].split("-"))
+        if first_id <= end and last_id >= start:
+            (dst / name).unlink(missing_ok=True)
+            manifest.pop(name, None)
+    with manifest_path.open(mode="w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def iter_thing_files(src_dir: pathlib.Path, start: int, end: int, depth: int = 0, prefix: str = ""):
+    """yield (thing_id, path) in id order, pruning directories outside start..end"""
+    if depth == ID_DIR_DEPTH:
+        for path in sorted(src_dir.glob("*.json")):
+            if "." in path.stem or not path.stem.isdigit():
+                continue
+            if start <= (thing_id := int(path.stem)) <= end:
+                yield thing_id, path
+        return
+    for child in sorted(src_dir.iterdir()):
+        if not child.is_dir() or len(child.name) != 1 or not child.name.isdigit():
+            continue
+        span = 10 ** (ID_DIGITS - depth - 1)
+        lowest = int(prefix + child.name) * span
+        if lowest > end or lowest + span - 1 < start:
+            continue
+        yield from iter_thing_files(child, start, end, depth + 1, prefix + child.name)
+
+
+def get_fingerprint(items: list[tuple[int, pathlib.Path]], normalize: bool, level: int) -> str:
+    h = hashlib.sha1(f"{normalize}:{level}".encode())
+    for thing_id, path in items:
+        st = path.stat()
+        h.update(f"{thing_id}:{st.st_size}:{st.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+
+def export_line(path: pathlib.Path, normalize: bool) -> t.Optional[bytes]:
+    with path.open(mode="r") as f:
+        data = json.load(f)
+    if "id" not in data:
+        # forbidden or not found
+        return None
+    if normalize:
+        # field names end in _ where they shadow builtins, keep the api names
+        data = dataclasses.asdict(Thing.load(data), dict_factory=lambda items: {k.rstrip("_"): v for k, v in items})
+    return json.dumps(data, separators=(",", ":"), default=str).encode() + b"\n"
+
+
 CREATE_THING_TABLE = """
 CREATE TABLE IF NOT EXISTS thing (
     id INTEGER PRIMARY KEY,
-    name STRING NOT NULL,
+    name TEXT NOT NULL,
     creator_id INTEGER NOT NULL,
     default_image_id INTEGER,
-    description STRING NOT NULL,
+    description TEXT NOT NULL,
+    added TEXT NOT NULL,
+    like_count INTEGER NOT NULL,
+    download_count INTEGER NOT NULL,
+    make_count INTEGER NOT NULL
 ) WITHOUT ROWID
 """
 
@@ -487,111 +685,168 @@ CREATE TABLE IF NOT EXISTS thing (
 CREATE_CREATOR_TABLE = """
 CREATE TABLE IF NOT EXISTS creator (
     id INTEGER PRIMARY KEY,
-    name STRING NOT NULL,
-    first_name STRING NOT NULL,
-    last_name STRING NOT NULL
+    name TEXT NOT NULL,
+    first_name TEXT NOT NULL,
+    last_name TEXT NOT NULL
+) WITHOUT ROWID
+"""
+
+
+CREATE_THING_TAG_TABLE = """
+CREATE TABLE IF NOT EXISTS thing_tag (
+    thing_id INTEGER NOT NULL,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (thing_id, tag)
 ) WITHOUT ROWID
 """
 
+
+# materialized aggregates, each thing contributes its counters to its creator
+# and to the day it was added (skipped when added is not a date), and one to
+# each of its tags; the triggers remove the old contribution and add the new
+# one so re-ingesting stays consistent
+CREATE_AGGREGATES = """
+CREATE TABLE IF NOT EXISTS creator_aggregate (
+    creator_id INTEGER PRIMARY KEY,
+    thing_count INTEGER NOT NULL,
+    like_count INTEGER NOT NULL,
+    download_count INTEGER NOT NULL,
+    make_count INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS day_aggregate (
+    day TEXT PRIMARY KEY,
+    thing_count INTEGER NOT NULL,
+    like_count INTEGER NOT NULL,
+    download_count INTEGER NOT NULL,
+    make_count INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS tag_aggregate (
+    tag TEXT PRIMARY KEY,
+    thing_count INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS tag_aggregate_thing_count ON tag_aggregate (thing_count DESC);
+
+CREATE TRIGGER IF NOT EXISTS thing_aggregate_insert AFTER INSERT ON thing
+BEGIN
+    INSERT INTO creator_aggregate VALUES (NEW.creator_id, 1, NEW.like_count, NEW.download_count, NEW.make_count)
+    ON CONFLICT (creator_id) DO UPDATE SET
+        thing_count = thing_count + 1,
+        like_count = like_count + excluded.like_count,
+        download_count = download_count + excluded.download_count,
+        make_count = make_count + excluded.make_count;
+    INSERT INTO day_aggregate
+    SELECT date(NEW.added), 1, NEW.like_count, NEW.download_count, NEW.make_count
+    WHERE date(NEW.added) IS NOT NULL
+    ON CONFLICT (day) DO UPDATE SET
+        thing_count = thing_count + 1,
+        like_count = like_count + excluded.like_count,
+        download_count = download_count + excluded.download_count,
+        make_count = make_count + excluded.make_count;
+END;
+
+CREATE TRIGGER IF NOT EXISTS thing_aggregate_update
+AFTER UPDATE OF creator_id, added, like_count, download_count, make_count ON thing
+WHEN OLD.creator_id IS NOT NEW.creator_id
+    OR OLD.added IS NOT NEW.added
+    OR OLD.like_count IS NOT NEW.like_count
+    OR OLD.download_count IS NOT NEW.download_count
+    OR OLD.make_count IS NOT NEW.make_count
+BEGIN
+    UPDATE creator_aggregate SET
+        thing_count = thing_count - 1,
+        like_count = like_count - OLD.like_count,
+        download_count = download_count - OLD.download_count,
+        make_count = make_count - OLD.make_count
+    WHERE creator_id = OLD.creator_id;
+    UPDATE day_aggregate SET
+        thing_count = thing_count - 1,
+        like_count = like_count - OLD.like_count,
+        download_count = download_count - OLD.download_count,
+        make_count = make_count - OLD.make_count
+    WHERE day = date(OLD.added);
+    INSERT INTO creator_aggregate VALUES (NEW.creator_id, 1, NEW.like_count, NEW.download_count, NEW.make_count)
+    ON CONFLICT (creator_id) DO UPDATE SET
+        thing_count = thing_count + 1,
+        like_count = like_count + excluded.like_count,
+        download_count = download_count + excluded.download_count,
+        make_count = make_count + excluded.make_count;
+    INSERT INTO day_aggregate
+    SELECT date(NEW.added), 1, NEW.like_count, NEW.download_count, NEW.make_count
+    WHERE date(NEW.added) IS NOT NULL
+    ON CONFLICT (day) DO UPDATE SET
+        thing_count = thing_count + 1,
+        like_count = like_count + excluded.like_count,
+        download_count = download_count + excluded.download_count,
+        make_count = make_count + excluded.make_count;
+    DELETE FROM creator_aggregate WHERE creator_id = OLD.creator_id AND thing_count = 0;
+    DELETE FROM day_aggregate WHERE day = date(OLD.added) AND thing_count = 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS thing_aggregate_delete AFTER DELETE ON thing
+BEGIN
+    UPDATE creator_aggregate SET
+        thing_count = thing_count - 1,
+        like_count = like_count - OLD.like_count,
+        download_count = download_count - OLD.download_count,
+        make_count = make_count - OLD.make_count
+    WHERE creator_id = OLD.creator_id;
+    UPDATE day_aggregate SET
+        thing_count = thing_count - 1,
+        like_count = like_count - OLD.like_count,
+        download_count = download_count - OLD.download_count,
+        make_count = make_count - OLD.make_count
+    WHERE day = date(OLD.added);
+    DELETE FROM creator_aggregate WHERE creator_id = OLD.creator_id AND thing_count = 0;
+    DELETE FROM day_aggregate WHERE day = date(OLD.added) AND thing_count = 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS thing_tag_aggregate_insert AFTER INSERT ON thing_tag
+BEGIN
+    INSERT INTO tag_aggregate VALUES (NEW.tag, 1)
+    ON CONFLICT (tag) DO UPDATE SET thing_count = thing_count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS thing_tag_aggregate_delete AFTER DELETE ON thing_tag
+BEGIN
+    UPDATE tag_aggregate SET thing_count = thing_count - 1 WHERE tag = OLD.tag;
+    DELETE FROM tag_aggregate WHERE tag = OLD.tag AND thing_count = 0;
+END;
+"""
+
+
+REBUILD_AGGREGATES = {
+    "creator_aggregate": """
+        SELECT creator_id, count(*), sum(like_count), sum(download_count), sum(make_count)
+        FROM thing GROUP BY creator_id
+    """,
+    "day_aggregate": """
+        SELECT date(added), count(*), sum(like_count), sum(download_count), sum(make_count)
+        FROM thing WHERE date(added) IS NOT NULL GROUP BY date(added)
+    """,
+    "tag_aggregate": """
+        SELECT tag, count(*) FROM thing_tag GROUP BY tag
+    """,
+}
+
+
 INSERT_THING = """
 INSERT INTO thing
 (
     id,
     name,
-    thumbnail,
-    url,
-    public_url,
     creator_id,
-    added,
-    modified,
-    is_published,
-    is_wip,
-    is_featured,
-    is_nsfw,
-    like_count,
-    is_liked,
-    collect_count,
-    is_collected,
-    comment_count,
-    is_watched,
     default_image_id,
     description,
-    instructions,
-    description_html,
-    instructions_html,
-    details,
-    edu_details,
-    license,
-    allows_derivatives,
-    files_url,
-    images_url,
-    likes_url,
-    ancestors_url,
-    derivatives_url,
-    tags_url,
-    categories_url,
-    file_count,
-    layout_count,
-    layouts_url,
-    is_private,
-    is_purchased,
-    in_library,
-    print_history_count,
-    app_id,
+    added,
+    like_count,
     download_count,
-    view_count,
-    remix_count,
-    make_count,
-    app_count,
-    root_comment_count,
-    moderation,
-    is_derivative,
-    can_comment
+    make_count
 )
 VALUES
 (
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
     ?,
     ?,
     ?,
@@ -602,11 +857,29 @@ VALUES
     ?,
     ?
 )
+ON CONFLICT (id) DO UPDATE SET
+    name = excluded.name,
+    creator_id = excluded.creator_id,
+    default_image_id = excluded.default_image_id,
+    description = excluded.description,
+    added = excluded.added,
+    like_count = excluded.like_count,
+    download_count = excluded.download_count,
+    make_count = excluded.make_count
 """
 
 
-INSERT_CREATOR = """INSERT INTO creator ( id, name, first_name, last_name) VALUES ( ?, ?, ?, ?)"""
+INSERT_CREATOR = """
+INSERT INTO creator ( id, name, first_name, last_name) VALUES ( ?, ?, ?, ?)
+ON CONFLICT (id) DO UPDATE SET name = excluded.name, first_name = excluded.first_name, last_name = excluded.last_name
+"""
+
+
+INSERT_THING_TAG = """INSERT OR IGNORE INTO thing_tag ( thing_id, tag) VALUES ( ?, ?)"""
+
+
+DELETE_STALE_THING_TAGS = """DELETE FROM thing_tag WHERE thing_id = ? AND tag NOT IN (SELECT value FROM json_each(?))"""
 
 
 if __name__ == "__main__":
-    main()
+    cli()
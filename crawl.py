@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
+import heapq
 import json
 import logging
 import os
 import pathlib
+import threading
 import time
 import urllib.parse
 
@@ -35,23 +38,125 @@ URL_BASE = urllib.parse.ParseResult(
     fragment="",
 )
 
+# sub-resources a thing links to, keyed by the name used in the saved filename
+SUBRESOURCES = {
+    "files": "files_url",
+    "images": "images_url",
+    "tags": "tags_url",
+    "ancestors": "ancestors_url",
+    "derivatives": "derivatives_url",
+    "layouts": "layouts_url",
+}
+
+# lower runs first, sub-resources of fetched things go ahead of new sweep ids
+PRIORITY_SUBRESOURCE = 0
+PRIORITY_THING = 1
+
+
+class RateLimiter:
+    """token bucket shared by every worker, one token per request"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
 
 @click.command()
 @click.option("--start", default=1, help="Thingiverse Start ID.")
 @click.option("--end", default=5028592, help="Thingiverse End ID.")
-def main(start: int, end: int):
-    for i in tqdm.tqdm(range(start, end + 1), ncols=80):
-        name = str(i).zfill(7)
-        filename = RESULTS_DIR / name[0] / name[1] / name[2] / name[3] / f"{name}.json"
-        if os.path.exists(filename):
-            logger.warning("thing exists: %d", i)
-            continue
-        try:
-            do_request(get_url(i), filename=filename, thing_id=i)
-        except Exception:
-            return
-        logger.info("thing saved: %d", i)
-        time.sleep(0.1)
+@click.option(
+    "--fanout",
+    multiple=True,
+    type=click.Choice([*SUBRESOURCES, "all"]),
+    help="Sub-resource to fetch for each thing, may be repeated.",
+)
+@click.option("--workers", default=8, help="Concurrent requests.")
+@click.option("--rate", default=10.0, help="Requests per second across all workers.")
+def main(start: int, end: int, fanout: tuple[str, ...], workers: int, rate: float):
+    resources = [*SUBRESOURCES] if "all" in fanout else [r for r in SUBRESOURCES if r in fanout]
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=workers))
+    limiter = RateLimiter(rate)
+    ids = iter(range(start, end + 1))
+    queue: list[tuple[int, int, str, str]] = []
+    queued_things = 0
+    in_flight: dict[concurrent.futures.Future, tuple[int, int, str, str]] = {}
+    failed = False
+    progress = tqdm.tqdm(total=end - start + 1, ncols=80)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # keep the sweep queued ahead so the workers never wait on it
+            while queued_things < 2 * workers and (i := next(ids, None)) is not None:
+                heapq.heappush(queue, (PRIORITY_THING, i, "", get_url(i)))
+                queued_things += 1
+            while not failed and queue and len(in_flight) < workers:
+                job = heapq.heappop(queue)
+                if job[0] == PRIORITY_THING:
+                    queued_things -= 1
+                in_flight[executor.submit(fetch, job, limiter)] = job
+            if not in_flight:
+                break
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                priority, i, resource, _ = in_flight.pop(future)
+                try:
+                    future.result()
+                except Exception:
+                    if priority == PRIORITY_THING:
+                        failed = True
+                    # a missing sub-resource is picked up again on the next run
+                    continue
+                if priority == PRIORITY_THING:
+                    progress.update(1)
+                    for job in get_subresource_jobs(i, get_filename(i), resources):
+                        heapq.heappush(queue, job)
+    progress.close()
+
+
+def fetch(job: tuple[int, int, str, str], limiter: RateLimiter):
+    _, i, resource, url = job
+    filename = get_filename(i, resource)
+    if os.path.exists(filename):
+        logger.warning("%s exists: %d", resource or "thing", i)
+        return
+    do_request(url, filename=filename, thing_id=i, limiter=limiter)
+    logger.info("%s saved: %d", resource or "thing", i)
+
+
+def get_filename(i: int, resource: str = "") -> pathlib.Path:
+    name = str(i).zfill(7)
+    suffix = f".{resource}.json" if resource else ".json"
+    return RESULTS_DIR / name[0] / name[1] / name[2] / name[3] / f"{name}{suffix}"
+
+
+def get_subresource_jobs(i: int, filename: pathlib.Path, resources: list[str]):
+    if not resources:
+        return
+    missing = [r for r in resources if not os.path.exists(get_filename(i, r))]
+    if not missing:
+        return
+    with filename.open(mode="r") as f:
+        data = json.load(f)
+    if "id" not in data:
+        # forbidden or not found, nothing to fan out to
+        return
+    for resource in missing:
+        if url := data.get(SUBRESOURCES[resource]):
+            yield (PRIORITY_SUBRESOURCE, i, resource, url)
 
 
 def get_url(i: int) -> str:
@@ -60,8 +165,9 @@ def get_url(i: int) -> str:
     return urllib.parse.urlunparse(u)
 
 
-def do_request(url: str, filename: pathlib.Path, thing_id: int, retries: int = 3):
+def do_request(url: str, filename: pathlib.Path, thing_id: int, limiter: RateLimiter, retries: int = 3):
     while retries > 0:
+        limiter.acquire()
         try:
             return _do_request(url, filename, thing_id)
         except Exception: